@@ -0,0 +1,113 @@
+# -*- coding: UTF-8 -*-
+"""使用本地模拟服务器测试身份池"""
+
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from weibo import Weibo
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """模拟微博接口，请求数超过阈值或cookie为banned的身份返回418"""
+    ban_threshold = 1000
+    counts = {}
+
+    def do_GET(self):
+        cookie = self.headers.get('Cookie', '')
+        counts = StubHandler.counts
+        counts[cookie] = counts.get(cookie, 0) + 1
+        if cookie == 'banned' or counts[cookie] > self.ban_threshold:
+            self.send_response(418)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(b'{"ok": 1}')
+
+    def log_message(self, *args):
+        pass
+
+
+class IdentityPoolTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), StubHandler)
+        cls.url = 'http://127.0.0.1:%d/' % cls.server.server_port
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StubHandler.counts = {}
+        StubHandler.ban_threshold = 1000
+
+    def get_weibo(self, cookies, strategy='round_robin', rate_limit=0):
+        config = {
+            'question_list': ['test'],
+            'cookie': '',
+            'filter': 1,
+            'since_date': 1,
+            'write_mode': ['csv'],
+            'pic_download': 0,
+            'video_download': 0,
+            'mysql_config': {},
+            'identity_pool': {
+                'strategy': strategy,
+                'rate_limit': rate_limit,
+                'quarantine_time': 600,
+                'identities': [{'cookie': cookie} for cookie in cookies]
+            }
+        }
+        return Weibo(config)
+
+    def test_round_robin_spreads_requests(self):
+        wb = self.get_weibo(['a', 'b', 'c'])
+        for _ in range(30):
+            self.assertEqual(wb.request(self.url).status_code, 200)
+        self.assertEqual(StubHandler.counts, {'a': 10, 'b': 10, 'c': 10})
+
+    def test_banned_identity_is_quarantined(self):
+        for strategy in ['round_robin', 'least_loaded']:
+            StubHandler.counts = {}
+            wb = self.get_weibo(['a', 'banned', 'b'], strategy=strategy)
+            for _ in range(20):
+                self.assertEqual(wb.request(self.url).status_code, 200)
+            banned = wb.identity_pool.identities[1]
+            self.assertEqual(StubHandler.counts['banned'], 1)
+            self.assertEqual(banned['bans'], 1)
+            self.assertGreater(banned['quarantine_until'], time.time())
+            self.assertEqual(StubHandler.counts['a'] + StubHandler.counts['b'],
+                             20)
+
+    def test_identity_over_threshold_is_replaced(self):
+        StubHandler.ban_threshold = 5
+        StubHandler.counts = {'a': 5}  # a已达到请求数上限
+        wb = self.get_weibo(['a', 'b', 'c'])
+        for _ in range(10):
+            self.assertEqual(wb.request(self.url).status_code, 200)
+        self.assertEqual(
+            [identity['bans'] for identity in wb.identity_pool.identities],
+            [1, 0, 0])
+        self.assertEqual(StubHandler.counts, {'a': 6, 'b': 5, 'c': 5})
+
+    def test_throughput_scales_with_identities(self):
+        elapsed = []
+        for cookies in [['a'], ['a', 'b', 'c']]:
+            wb = self.get_weibo(cookies, strategy='least_loaded', rate_limit=10)
+            start = time.time()
+            for _ in range(12):
+                wb.request(self.url)
+            elapsed.append(time.time() - start)
+        self.assertGreater(elapsed[0], 1.0)  # 单个身份每秒最多10次请求
+        self.assertLess(elapsed[1], elapsed[0] * 0.6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,14 +3,21 @@
 
 import codecs
 import csv
+import gzip
+import hashlib
+import heapq
+import io
 import json
 import math
 import os
 import random
+import sqlite3
 import sys
+import tempfile
+import time
 import traceback
 from collections import OrderedDict
-from datetime import date, datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
 from time import sleep
 
 from collections import defaultdict
@@ -21,6 +28,806 @@ from lxml import etree
 from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 
+try:
+    import orjson  # 安装orjson后使用更快的json解析
+except ImportError:
+    orjson = None
+
+DEFAULT_USER_AGENT = ('Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 '
+                      '(KHTML, like Gecko) Chrome/70.0.3534.4 Safari/537.36')
+
+
+class ResponseError(Exception):
+    """响应无法解析为json，如封禁页面、登录页面或错误页面"""
+    def __init__(self, message, response=None):
+        super(ResponseError, self).__init__(message)
+        self.status_code = response.status_code if response is not None else None
+        self.url = response.url if response is not None else None
+
+
+def loads_json(content):
+    """解析json，content可以为str或bytes"""
+    if orjson:
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            pass  # orjson不接受字符串中的控制字符，交给标准库宽松解析
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+    return json.loads(content, strict=False)
+
+
+class IdentityPool(object):
+    """身份池，轮换多组cookie/User-Agent/代理，并对每个身份单独限速"""
+    BAN_STATUS_CODES = (403, 418, 429, 432)
+
+    def __init__(self,
+                 identities,
+                 strategy='round_robin',
+                 rate_limit=0.5,
+                 quarantine_time=600,
+                 min_health=0.2):
+        if not identities:
+            identities = [{}]
+        self.identities = []
+        for i, identity in enumerate(identities):
+            self.identities.append({
+                'name': identity.get('name', 'identity_%d' % i),
+                'cookie': identity.get('cookie', ''),
+                'user_agent': identity.get('user_agent') or DEFAULT_USER_AGENT,
+                'proxy': identity.get('proxy', ''),
+                'interval': self.get_interval(
+                    identity.get('rate_limit', rate_limit)),
+                'health': 1.0,
+                'next_time': 0.0,  # 下一次允许发出请求的时间
+                'quarantine_until': 0.0,  # 隔离解除时间
+                'requests': 0,
+                'failures': 0,
+                'bans': 0,
+            })
+        self.strategy = strategy  # round_robin或least_loaded
+        self.quarantine_time = quarantine_time  # 被封禁后的隔离时长(秒)，0代表不隔离
+        self.min_health = min_health  # 健康分低于该值时同样进入隔离
+        self.cursor = 0
+
+    def get_interval(self, rate_limit):
+        """由每秒请求数限制计算请求间隔，0代表不限速"""
+        if not rate_limit:
+            return 0.0
+        return 1.0 / rate_limit
+
+    def is_paced(self):
+        """是否由身份池按各身份的限速控制请求节奏"""
+        return any(identity['interval'] > 0 for identity in self.identities)
+
+    def healthy_identities(self, now):
+        """获取未被隔离的身份"""
+        return [
+            identity for identity in self.identities
+            if identity['quarantine_until'] <= now
+        ]
+
+    def acquire(self):
+        """选出一个身份，必要时等待到该身份的限速时间点"""
+        now = time.time()
+        healthy = self.healthy_identities(now)
+        if not healthy:
+            # 全部身份都被隔离时，等待最早解除隔离的身份
+            identity = min(self.identities,
+                           key=lambda x: x['quarantine_until'])
+            sleep(max(identity['quarantine_until'] - now, 0))
+            identity['health'] = max(identity['health'], self.min_health)
+            healthy = [identity]
+        if self.strategy == 'least_loaded':
+            identity = min(healthy,
+                           key=lambda x:
+                           (x['next_time'], -x['health'], x['requests']))
+        else:
+            identity = None
+            for _ in range(len(self.identities)):
+                candidate = self.identities[self.cursor]
+                self.cursor = (self.cursor + 1) % len(self.identities)
+                if candidate in healthy:
+                    identity = candidate
+                    break
+            if identity is None:
+                identity = healthy[0]
+        wait = identity['next_time'] - time.time()
+        if wait > 0:
+            sleep(wait)
+        identity['next_time'] = time.time() + identity['interval']
+        identity['requests'] += 1
+        return identity
+
+    def report_success(self, identity):
+        """请求成功，恢复健康分"""
+        identity['health'] = min(1.0, identity['health'] + 0.1)
+
+    def report_failure(self, identity):
+        """请求失败(超时、连接错误等)，降低健康分"""
+        identity['failures'] += 1
+        identity['health'] -= 0.2
+        if identity['health'] < self.min_health:
+            self.quarantine(identity)
+
+    def report_ban(self, identity):
+        """请求被封禁，隔离该身份"""
+        identity['bans'] += 1
+        identity['health'] /= 2
+        self.quarantine(identity)
+
+    def quarantine(self, identity):
+        """隔离身份，到期后自动恢复"""
+        if not self.quarantine_time:
+            return
+        identity['quarantine_until'] = time.time() + self.quarantine_time
+        print(u'身份%s已被隔离%d秒' % (identity['name'], self.quarantine_time))
+
+    def is_banned(self, response):
+        """判断响应是否为封禁页面"""
+        if response.status_code in self.BAN_STATUS_CODES:
+            return True
+        return 'passport.weibo' in response.url
+
+    def get_headers(self, identity):
+        """获取身份对应的请求头"""
+        headers = {'User-Agent': identity['user_agent']}
+        if identity['cookie']:
+            headers['Cookie'] = identity['cookie']
+        return headers
+
+    def get_proxies(self, identity):
+        """获取身份对应的代理"""
+        if identity['proxy']:
+            return {'http': identity['proxy'], 'https': identity['proxy']}
+        return None
+
+
+class TextSanitizer(object):
+    """文本清洗，去除零宽字符、控制字符及目标编码无法表示的字符"""
+    REMOVED_CHARS = [u'\u200b', u'\u200c', u'\u200d', u'\u2060', u'\ufeff'
+                     ] + [
+                         chr(c) for c in list(range(0x20)) +
+                         list(range(0x7f, 0xa0)) if chr(c) not in '\t\n\r'
+                     ]
+    # 可以表示全部Unicode字符的编码，只需额外去除单独的代理字符
+    UNICODE_ENCODINGS = ['utf-8', 'utf-16', 'utf-32', 'gb18030']
+
+    def __init__(self, encoding='utf-8'):
+        self.encoding = encoding  # 输出编码，与sys.stdout无关
+        name = codecs.lookup(encoding).name
+        self.is_unicode = any(
+            name.startswith(e) for e in self.UNICODE_ENCODINGS)
+        # 预先编译要去除的字符集合，不含这些字符的字符串不会被复制
+        chars = ''.join(re.escape(c) for c in self.REMOVED_CHARS)
+        if self.is_unicode:
+            chars += u'\ud800-\udfff'
+        self.pattern = re.compile(u'[%s]' % chars)
+
+    def sanitize(self, text):
+        """清洗单个字符串"""
+        if self.pattern.search(text):
+            text = self.pattern.sub('', text)
+        if not self.is_unicode:
+            text = text.encode(self.encoding,
+                               'ignore').decode(self.encoding)
+        return text
+
+    def sanitize_record(self, record):
+        """清洗一条记录中的全部字符串字段"""
+        for k, v in record.items():
+            if isinstance(v, str):
+                record[k] = self.sanitize(v)
+        return record
+
+    def sanitize_records(self, records):
+        """批量清洗记录"""
+        for record in records:
+            self.sanitize_record(record)
+        return records
+
+
+class TimestampNormalizer(object):
+    """微博时间标准化，将各种时间格式转换为北京时间的完整日期时间"""
+    CHINA_TZ = timezone(timedelta(hours=8))
+    EPOCH = datetime(1970, 1, 1) + timedelta(hours=8)  # 北京时间的1970-01-01 00:00:00 UTC
+    MONTHS = {
+        'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+        'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12
+    }
+    RELATIVE_UNITS = [(u'秒', 'seconds'), (u'分钟', 'minutes'),
+                      (u'小时', 'hours'), (u'天', 'days')]
+    FORMAT = '%Y-%m-%d %H:%M:%S'
+
+    def __init__(self, max_cache_size=100000):
+        self.max_cache_size = max_cache_size
+        self.absolute_cache = {}  # 与当前时间无关的时间字符串的解析结果
+        self.relative_cache = {}  # "刚刚"、"N分钟前"等相对时间的解析结果
+        self.reset_clock()
+
+    def reset_clock(self):
+        """读取一次当前时间，供同一批次的相对时间共用"""
+        self.now = datetime.now(self.CHINA_TZ).replace(tzinfo=None,
+                                                       microsecond=0)
+        self.relative_cache = {}
+
+    def set_clock(self, now):
+        """使用指定的当前时间，如重试时使用原先获取数据时的时间"""
+        self.now = now
+        self.relative_cache = {}
+
+    def parse(self, created_at):
+        """将微博时间解析为datetime，无法解析时返回None"""
+        if created_at in self.absolute_cache:
+            return self.absolute_cache[created_at]
+        if created_at in self.relative_cache:
+            return self.relative_cache[created_at]
+        result, is_relative = self.parse_uncached(created_at.strip())
+        cache = self.relative_cache if is_relative else self.absolute_cache
+        if len(cache) >= self.max_cache_size:
+            cache.clear()
+        cache[created_at] = result
+        return result
+
+    def parse_uncached(self, created_at):
+        """解析时间，返回(datetime, 是否依赖当前时间)"""
+        if u'刚刚' in created_at:
+            return self.now, True
+        for unit, name in self.RELATIVE_UNITS:
+            if unit in created_at:
+                number = created_at[:created_at.find(unit)].strip()
+                if number.isdigit():
+                    return self.now - timedelta(**{name: int(number)}), True
+        for prefix, days in [(u'昨天', 1), (u'今天', 0)]:
+            if created_at.startswith(prefix):
+                day = (self.now - timedelta(days=days)).date()
+                try:
+                    return self.combine(day, created_at[len(prefix):]), True
+                except ValueError:
+                    return None, False
+        parts = created_at.split()
+        if len(parts) == 6 and parts[1] in self.MONTHS:
+            # API返回的长格式，如"Sat Oct 17 12:34:56 +0800 2020"
+            try:
+                dt = datetime(int(parts[5]), self.MONTHS[parts[1]],
+                              int(parts[2]),
+                              *[int(t) for t in parts[3].split(':')])
+                offset = parts[4]
+                sign = -1 if offset[0] == '-' else 1
+                offset = timedelta(hours=int(offset[1:3]),
+                                   minutes=int(offset[3:5])) * sign
+                return dt - offset + timedelta(hours=8), False
+            except (ValueError, IndexError):
+                return None, False
+        day = parts[0] if parts else ''
+        clock = ' '.join(parts[1:])
+        try:
+            if day.count('-') == 1:
+                # 今年的微博只显示月日，如"01-02"
+                month, mday = [int(d) for d in day.split('-')]
+                dt = self.combine(date(self.now.year, month, mday), clock)
+                if dt > self.now:
+                    dt = dt.replace(year=dt.year - 1)
+                return dt, True
+            if day.count('-') == 2:
+                year, month, mday = [int(d) for d in day.split('-')]
+                return self.combine(date(year, month, mday), clock), False
+        except ValueError:
+            pass
+        return None, False
+
+    def combine(self, day, clock):
+        """合并日期和"HH:MM"形式的时间"""
+        clock = clock.strip()
+        if not clock:
+            return datetime(day.year, day.month, day.day)
+        numbers = [int(t) for t in clock.split(':')]
+        return datetime(day.year, day.month, day.day, *numbers)
+
+    def normalize(self, created_at):
+        """将微博时间转换为yyyy-mm-dd HH:MM:SS形式，无法解析时原样返回"""
+        dt = self.parse(created_at)
+        if dt is None:
+            return created_at
+        return dt.strftime(self.FORMAT)
+
+    def to_timestamp(self, created_at):
+        """将微博时间转换为秒级时间戳，无法解析时返回None"""
+        dt = self.parse(created_at)
+        if dt is None:
+            return None
+        return int((dt - self.EPOCH).total_seconds())
+
+
+class PartitionWriter(object):
+    """按发布日期和类型(微博/评论)分区写入压缩的csv文件，单个文件超过大小上限时轮转
+
+    目录结构为<kind>/<yyyy-mm-dd>/part-00000.csv.gz，manifest.json记录每个分区文件的
+    行数和id范围。同时打开的文件数有上限，被关闭的文件再次写入时追加新的压缩帧；
+    只有超过大小上限的文件和上次运行留下的文件不再追加，重复运行时写入新的分区文件
+    """
+    EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst', 'none': ''}
+
+    def __init__(self,
+                 base_dir,
+                 compression='gzip',
+                 max_bytes=256 * 1024 * 1024,
+                 max_open=16):
+        self.base_dir = base_dir
+        self.compression = compression
+        self.max_bytes = max_bytes  # 单个分区文件压缩后的大小上限
+        self.max_open = max_open  # 同时打开的分区文件数上限
+        self.manifest_path = base_dir + os.sep + 'manifest.json'
+        self.open_files = OrderedDict()  # (kind, day)到打开的分区文件
+        self.current = {}  # (kind, day)到本次运行中可继续追加的分区
+        self.manifest = {'partitions': []}
+        if compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                sys.exit(
+                    u'系统中可能没有安装zstandard库，请先运行 pip install zstandard ，再运行程序')
+            self.zstandard = zstandard
+        if not os.path.isdir(base_dir):
+            os.makedirs(base_dir)
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, encoding='utf-8') as f:
+                self.manifest = json.load(f)
+            for entry in self.manifest['partitions']:
+                entry['closed'] = True  # 上次未正常关闭的文件也不再追加
+
+    def get_day(self, created_at):
+        """获取分区日期，无法识别的时间归入unknown分区"""
+        day = str(created_at)[:10]
+        if len(day) == 10 and day[4] == '-' and day[7] == '-':
+            return day
+        return 'unknown'
+
+    def get_file_path(self, entry):
+        """获取分区文件的完整路径"""
+        return self.base_dir + os.sep + entry['path'].replace('/', os.sep)
+
+    def new_entry(self, kind, day):
+        """在manifest中登记(kind, day)的新分区文件"""
+        part = len([
+            e for e in self.manifest['partitions']
+            if e['kind'] == kind and e['date'] == day
+        ])
+        entry = {
+            'path': kind + '/' + day + '/part-%05d.csv' % part +
+            self.EXTENSIONS[self.compression],
+            'kind': kind,
+            'date': day,
+            'part': part,
+            'compression': self.compression,
+            'rows': 0,
+            'min_id': None,
+            'max_id': None,
+            'bytes': 0,
+            'closed': False
+        }
+        self.manifest['partitions'].append(entry)
+        return entry
+
+    def open(self, kind, day, headers):
+        """打开(kind, day)的分区文件，之前被关闭的文件以新的压缩帧继续追加"""
+        if len(self.open_files) >= self.max_open:
+            self.close(next(iter(self.open_files)))
+        entry = self.current.get((kind, day))
+        is_new = entry is None or entry['closed']
+        if is_new:
+            entry = self.new_entry(kind, day)
+            self.current[(kind, day)] = entry
+        file_path = self.get_file_path(entry)
+        if not os.path.isdir(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+        raw = open(file_path, 'wb' if is_new else 'ab')
+        if self.compression == 'gzip':
+            stream = gzip.GzipFile(fileobj=raw, mode='wb')
+        elif self.compression == 'zstd':
+            stream = self.zstandard.ZstdCompressor().stream_writer(
+                raw, closefd=False)
+        else:
+            stream = raw
+        text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+        partition = {
+            'raw': raw,
+            'stream': stream,
+            'text': text,
+            'writer': csv.writer(text),
+            'entry': entry
+        }
+        if is_new:
+            partition['writer'].writerow(headers)
+        self.open_files[(kind, day)] = partition
+        return partition
+
+    def write_rows(self, kind, day, headers, rows):
+        """向(kind, day)分区写入多行，rows为(微博id, 行)的列表"""
+        key = (kind, day)
+        for weibo_id, row in rows:
+            partition = self.open_files.get(key)
+            if partition is None:
+                partition = self.open(kind, day, headers)
+            partition['writer'].writerow(row)
+            entry = partition['entry']
+            entry['rows'] += 1
+            weibo_id = int(weibo_id) if str(
+                weibo_id).isdigit() else weibo_id
+            if entry['min_id'] is None or get_id_key(
+                    str(weibo_id)) < get_id_key(str(entry['min_id'])):
+                entry['min_id'] = weibo_id
+            if entry['max_id'] is None or get_id_key(
+                    str(weibo_id)) > get_id_key(str(entry['max_id'])):
+                entry['max_id'] = weibo_id
+            if partition['raw'].tell() >= self.max_bytes:
+                self.close(key, seal=True)
+        if key in self.open_files:
+            self.open_files.move_to_end(key)
+
+    def close(self, key, seal=False):
+        """关闭分区文件，seal为True时该文件不再追加，之后写入新的分区文件"""
+        partition = self.open_files.pop(key)
+        partition['text'].close()  # 会同时结束压缩流
+        partition['raw'].close()
+        entry = partition['entry']
+        entry['bytes'] = os.path.getsize(self.get_file_path(entry))
+        if seal:
+            entry['closed'] = True
+
+    def flush(self):
+        """将已写入的数据刷新到磁盘并更新manifest"""
+        for partition in self.open_files.values():
+            partition['text'].flush()
+            partition['stream'].flush()
+            partition['raw'].flush()
+            partition['entry']['bytes'] = partition['raw'].tell()
+        self.save_manifest()
+
+    def close_all(self):
+        """关闭全部分区文件并更新manifest"""
+        for key in list(self.open_files):
+            self.close(key)
+        for entry in self.current.values():
+            entry['closed'] = True
+        self.current = {}
+        self.save_manifest()
+
+    def save_manifest(self):
+        """写入manifest.json"""
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+
+class HeavyHitters(object):
+    """容量有限的高频项计数(Space-Saving算法)，计数可能偏大，偏大的上限为error"""
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.heap = []  # (计数, 项)的最小堆，计数变化后旧记录留在堆中，取出时跳过
+
+    def push(self, key):
+        """将一项的当前计数加入堆，过期记录过多时重建堆"""
+        heapq.heappush(self.heap, (self.counts[key], key))
+        if len(self.heap) > 4 * max(self.capacity, 1):
+            self.heap = [(count, key) for key, count in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def pop_min(self):
+        """取出计数最小的项"""
+        while True:
+            count, key = heapq.heappop(self.heap)
+            if self.counts.get(key) == count:
+                return key
+
+    def add(self, key, count=1):
+        """增加一项的计数，容量已满时替换计数最小的项"""
+        if key in self.counts:
+            self.counts[key] += count
+            self.push(key)
+            return
+        if len(self.counts) < self.capacity:
+            self.counts[key] = count
+            self.errors[key] = 0
+            self.push(key)
+            return
+        min_key = self.pop_min()
+        min_count = self.counts.pop(min_key)
+        del self.errors[min_key]
+        self.counts[key] = min_count + count
+        self.errors[key] = min_count
+        self.push(key)
+
+    def top(self, n):
+        """获取计数最高的n项"""
+        keys = sorted(self.counts, key=self.counts.get, reverse=True)[:n]
+        return [{
+            'key': key,
+            'count': self.counts[key],
+            'error': self.errors[key]
+        } for key in keys]
+
+
+class TopicAnalytics(object):
+    """爬取过程中增量统计话题数据，不需要重新读取结果文件"""
+    HISTOGRAM_BINS = 64  # 按2的幂分桶，第k个桶为[2^(k-1), 2^k)
+    COUNT_FIELDS = ['attitudes_count', 'comments_count', 'reposts_count']
+
+    def __init__(self, capacity=1000, top_n=50):
+        try:
+            import numpy as np
+        except ImportError:
+            sys.exit(u'系统中可能没有安装numpy库，请先运行 pip install numpy ，再运行程序')
+        self.np = np
+        self.top_n = top_n
+        self.base_hour = None  # 第一个小时桶对应的时间戳(小时)
+        self.hour_counts = np.zeros((2, 0), dtype=np.int64)  # 第0行为微博，第1行为评论
+        self.histograms = np.zeros((len(self.COUNT_FIELDS),
+                                    self.HISTOGRAM_BINS),
+                                   dtype=np.int64)
+        self.totals = np.zeros(len(self.COUNT_FIELDS), dtype=np.int64)
+        self.maxima = np.zeros(len(self.COUNT_FIELDS), dtype=np.int64)
+        self.post_count = 0
+        self.comment_count = 0
+        self.users = HeavyHitters(capacity)
+        self.commenters = HeavyHitters(capacity)
+        self.topics = HeavyHitters(capacity)
+        self.at_users = HeavyHitters(capacity)
+        self.topic_pairs = HeavyHitters(capacity)
+        self.topic_at_pairs = HeavyHitters(capacity)
+
+    def add_hour(self, row, timestamp):
+        """在对应的小时桶中计数，必要时向前或向后扩展数组"""
+        if timestamp is None:
+            return
+        hour = timestamp // 3600
+        if self.base_hour is None:
+            self.base_hour = hour
+        if hour < self.base_hour:
+            shift = self.base_hour - hour
+            self.hour_counts = self.np.concatenate(
+                (self.np.zeros((2, shift), dtype=self.np.int64),
+                 self.hour_counts),
+                axis=1)
+            self.base_hour = hour
+        index = hour - self.base_hour
+        size = self.hour_counts.shape[1]
+        if index >= size:
+            grown = self.np.zeros((2, max(index + 1, size * 2)),
+                                  dtype=self.np.int64)
+            grown[:, :size] = self.hour_counts
+            self.hour_counts = grown
+        self.hour_counts[row, index] += 1
+
+    def split(self, value):
+        """将逗号分隔的字段拆分为列表"""
+        if isinstance(value, list):
+            return value
+        return [v for v in value.split(',') if v] if value else []
+
+    def add_post(self, weibo, timestamp):
+        """统计一条微博"""
+        self.post_count += 1
+        self.add_hour(0, timestamp)
+        for i, field in enumerate(self.COUNT_FIELDS):
+            value = max(int(weibo.get(field) or 0), 0)
+            self.histograms[i, value.bit_length()] += 1
+            self.totals[i] += value
+            self.maxima[i] = max(self.maxima[i], value)
+        if weibo.get('screen_name'):
+            self.users.add(weibo['screen_name'])
+        topics = sorted(set(self.split(weibo.get('topics'))))
+        at_users = sorted(set(self.split(weibo.get('at_users'))))
+        for topic in topics:
+            self.topics.add(topic)
+        for at_user in at_users:
+            self.at_users.add(at_user)
+        for i, topic in enumerate(topics):
+            for other in topics[i + 1:]:
+                self.topic_pairs.add((topic, other))
+            for at_user in at_users:
+                self.topic_at_pairs.add((topic, at_user))
+
+    def add_comment(self, comment, timestamp):
+        """统计一条评论"""
+        self.comment_count += 1
+        self.add_hour(1, timestamp)
+        if comment.get('screen_name'):
+            self.commenters.add(comment['screen_name'])
+
+    def get_histogram(self, i):
+        """获取非空的分桶统计"""
+        histogram = []
+        for k in self.np.nonzero(self.histograms[i])[0]:
+            k = int(k)
+            histogram.append({
+                'min': 0 if k == 0 else 2**(k - 1),
+                'max': 0 if k == 0 else 2**k - 1,
+                'count': int(self.histograms[i, k])
+            })
+        return histogram
+
+    def get_top_pairs(self, hitters):
+        """获取出现次数最多的组合"""
+        top = hitters.top(self.top_n)
+        for item in top:
+            item['key'] = list(item['key'])
+        return top
+
+    def get_summary(self):
+        """获取统计结果"""
+        hours = []
+        if self.base_hour is not None:
+            for index in self.np.nonzero(self.hour_counts.sum(axis=0))[0]:
+                hour = datetime(1970, 1, 1) + timedelta(
+                    hours=int(self.base_hour + index) + 8)
+                hours.append({
+                    'hour': hour.strftime('%Y-%m-%d %H:00'),
+                    'posts': int(self.hour_counts[0, index]),
+                    'comments': int(self.hour_counts[1, index])
+                })
+        counts = {}
+        for i, field in enumerate(self.COUNT_FIELDS):
+            counts[field] = {
+                'total': int(self.totals[i]),
+                'max': int(self.maxima[i]),
+                'mean': float(self.totals[i]) / self.post_count
+                if self.post_count else 0.0,
+                'histogram': self.get_histogram(i)
+            }
+        return {
+            'posts': self.post_count,
+            'comments': self.comment_count,
+            'per_hour': hours,
+            'counts': counts,
+            'top_users': self.users.top(self.top_n),
+            'top_commenters': self.commenters.top(self.top_n),
+            'top_topics': self.topics.top(self.top_n),
+            'top_at_users': self.at_users.top(self.top_n),
+            'topic_pairs': self.get_top_pairs(self.topic_pairs),
+            'topic_at_user_pairs': self.get_top_pairs(self.topic_at_pairs)
+        }
+
+
+class LRUCache(object):
+    """容量有限的LRU缓存，记录命中与未命中次数"""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """获取缓存值，不存在时返回None"""
+        if key in self.data:
+            self.data.move_to_end(key)
+            self.hits += 1
+            return self.data[key]
+        self.misses += 1
+
+    def put(self, key, value):
+        """写入缓存，超出容量时淘汰最久未使用的值"""
+        if self.maxsize <= 0:
+            return
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        """清空缓存值"""
+        self.data.clear()
+
+    def get_stats(self):
+        """获取缓存统计信息"""
+        total = self.hits + self.misses
+        hit_rate = float(self.hits) / total if total else 0.0
+        return {
+            'size': len(self.data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': hit_rate
+        }
+
+
+class MediaStore(object):
+    """按内容寻址的媒体文件仓库，所有话题共用一份文件"""
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.object_dir = store_dir + os.sep + 'objects'
+        self.index_path = store_dir + os.sep + 'index.jsonl'
+        self.url_index = {}  # url到文件内容hash的映射
+        self.hash_index = {}  # 文件内容hash到仓库文件路径的映射
+        self.manifests = {}  # manifest路径到其中已记录的文件名的映射
+        if not os.path.isdir(self.object_dir):
+            os.makedirs(self.object_dir)
+        self.load_index()
+
+    def load_index(self):
+        """读取索引文件"""
+        if not os.path.isfile(self.index_path):
+            return
+        with open(self.index_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # 忽略上次中断时写了一半的行
+                object_path = self.get_object_path(entry['hash'],
+                                                   entry['ext'])
+                if os.path.isfile(object_path):
+                    self.url_index[entry['url']] = entry['hash']
+                    self.hash_index[entry['hash']] = object_path
+
+    def get_object_path(self, content_hash, ext):
+        """获取内容hash对应的仓库文件路径"""
+        return (self.object_dir + os.sep + content_hash[:2] + os.sep +
+                content_hash + ext)
+
+    def get(self, url):
+        """获取url对应的仓库文件路径，未下载过时返回None"""
+        content_hash = self.url_index.get(url)
+        if content_hash:
+            return self.hash_index.get(content_hash)
+
+    def put(self, url, content, ext):
+        """保存文件内容并记录索引，内容相同的文件只保存一份"""
+        content_hash = hashlib.sha256(content).hexdigest()
+        object_path = self.hash_index.get(content_hash)
+        if not object_path:
+            object_path = self.get_object_path(content_hash, ext)
+            object_dir = os.path.dirname(object_path)
+            if not os.path.isdir(object_dir):
+                os.makedirs(object_dir)
+            tmp_path = object_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, object_path)
+            self.hash_index[content_hash] = object_path
+        else:
+            ext = os.path.splitext(object_path)[1]
+        self.url_index[url] = content_hash
+        with open(self.index_path, 'a', encoding='utf-8') as f:
+            f.write(
+                json.dumps({
+                    'url': url,
+                    'hash': content_hash,
+                    'ext': ext,
+                    'size': len(content)
+                }) + '\n')
+        return object_path
+
+    def link(self, object_path, file_path):
+        """在话题目录中创建指向仓库文件的硬链接，不支持硬链接时记入manifest"""
+        if os.path.isfile(file_path):
+            return
+        try:
+            os.link(object_path, file_path)
+        except (OSError, AttributeError):
+            manifest = os.path.dirname(file_path) + os.sep + 'manifest.txt'
+            names = self.load_manifest(manifest)
+            name = os.path.basename(file_path)
+            if name in names:
+                return
+            with open(manifest, 'a', encoding='utf-8') as f:
+                f.write(name + '\t' + object_path + '\n')
+            names.add(name)
+
+    def load_manifest(self, manifest):
+        """读取manifest中已记录的文件名，同一目录只读取一次"""
+        if manifest not in self.manifests:
+            names = set()
+            if os.path.isfile(manifest):
+                with open(manifest, encoding='utf-8') as f:
+                    for line in f:
+                        if '\t' in line:
+                            names.add(line.split('\t', 1)[0])
+            self.manifests[manifest] = names
+        return self.manifests[manifest]
+
 
 class Weibo(object):
     def __init__(self, config):
@@ -33,13 +840,31 @@ class Weibo(object):
             since_date = str(date.today() - timedelta(int(since_date)))
         self.since_date = since_date  # 起始时间，即爬取发布日期从该值到现在的微博，形式为yyyy-mm-dd
         self.write_mode = config[
-            'write_mode']  # 结果信息保存类型，为list形式，可包含csv、mongo和mysql三种类型
+            'write_mode']  # 结果信息保存类型，为list形式，可包含csv、mongo、mysql、sqlite和partition五种类型
         self.pic_download = config[
             'pic_download']  # 取值范围为0、1,程序默认值为0,代表不下载微博原始图片,1代表下载
         self.video_download = config[
             'video_download']  # 取值范围为0、1,程序默认为0,代表不下载微博视频,1代表下载
         self.mysql_config = config['mysql_config']  # MySQL数据库连接配置，可以不填
         self.cookie = config['cookie']
+        self.identity_pool = self.get_identity_pool(
+            config.get('identity_pool'))  # 身份池，可以不填，默认只使用cookie
+        self.media_store = None  # 图片/视频仓库，下载文件时创建
+        self.sanitizer = TextSanitizer(config.get(
+            'output_encoding', 'utf-8'))  # 文本清洗，输出编码默认为utf-8
+        self.timestamps = TimestampNormalizer()  # 微博及评论发布时间标准化
+        self.analytics_enabled = config.get(
+            'analytics', 0)  # 取值范围为0、1,默认为0,1代表爬取时统计话题数据并写入summary.json
+        self.analytics = None  # 当前话题的统计数据
+        self.max_retries = config.get('max_retries',
+                                      3)  # 单条微博、单页评论等失败时的重试次数
+        self.retry_backoff = config.get('retry_backoff',
+                                        2)  # 首次重试前等待的秒数，之后每次加倍
+        self.dead_letter_count = 0  # 本次运行写入的死信数
+        self.retweet_cache = LRUCache(config.get(
+            'retweet_cache_size', 1000))  # 已解析的源微博缓存，整个运行期间共用
+        self.truncated_retweets = LRUCache(config.get(
+            'retweet_cache_size', 1000))  # 全文获取失败的源微博，本次运行不再重试
         question_list = config['question_list']
         if not isinstance(question_list, list):
             if not os.path.isabs(question_list):
@@ -52,6 +877,11 @@ class Weibo(object):
         self.got_count = 0  # 存储爬取到的微博数
         self.weibo = []  # 存储爬取到的所有微博信息
         self.weibo_id_list = []  # 存储爬取到的所有微博id
+        self.comment_parent = {}  # 存储爬取到的评论id及其所属微博id
+        self.sqlite_connection = None  # SQLite数据库连接，首次写入时创建
+        self.partition_config = config.get(
+            'partition_config', {})  # 分区输出配置，可以不填，默认使用gzip压缩
+        self.partition_writer = None  # 当前话题的分区文件
 
     def validate_config(self, config):
         """验证配置是否正确"""
@@ -62,20 +892,30 @@ class Weibo(object):
             if config[argument] != 0 and config[argument] != 1:
                 sys.exit(u'%s值应为0或1,请重新输入' % config[argument])
 
+        # 验证analytics
+        if config.get('analytics', 0) not in [0, 1]:
+            sys.exit(u'analytics值应为0或1,请重新输入')
+
         # 验证since_date
         since_date = str(config['since_date'])
         if (not self.is_date(since_date)) and (not since_date.isdigit()):
             sys.exit(u'since_date值应为yyyy-mm-dd形式或整数,请重新输入')
 
         # 验证write_mode
-        write_mode = ['csv', 'mongo', 'mysql']
+        write_mode = ['csv', 'mongo', 'mysql', 'sqlite', 'partition']
         if not isinstance(config['write_mode'], list):
             sys.exit(u'write_mode值应为list类型')
         for mode in config['write_mode']:
             if mode not in write_mode:
-                sys.exit(u'%s为无效模式，请从txt、csv、mongo和mysql挑选一个或多个作为write_mode' %
+                sys.exit(u'%s为无效模式，请从csv、mongo、mysql、sqlite和partition挑选一个或多个作为write_mode' %
                          mode)
 
+        # 验证partition_config
+        partition_config = config.get('partition_config', {})
+        if partition_config.get('compression',
+                                'gzip') not in PartitionWriter.EXTENSIONS:
+            sys.exit(u'partition_config的compression值应为gzip、zstd或none')
+
         # 验证question_list
         question_list = config['question_list']
         if (not isinstance(question_list,
@@ -90,6 +930,31 @@ class Weibo(object):
                     u'当前路径：%s 不存在question_list.txt文件' %
                     (os.path.split(os.path.realpath(__file__))[0] + os.sep))
 
+        # 验证identity_pool
+        identity_pool = config.get('identity_pool')
+        if identity_pool:
+            if not isinstance(identity_pool, dict) or not isinstance(
+                    identity_pool.get('identities'), list):
+                sys.exit(u'identity_pool值应为dict类型，且identities应为list类型')
+            if identity_pool.get('strategy', 'round_robin') not in [
+                    'round_robin', 'least_loaded'
+            ]:
+                sys.exit(u'identity_pool的strategy值应为round_robin或least_loaded')
+
+    def get_identity_pool(self, pool_config):
+        """根据配置创建身份池"""
+        if not pool_config or not pool_config['identities']:
+            # 只有一个cookie时不限速也不隔离，隔离唯一的身份会使整个爬虫停止等待
+            return IdentityPool([{'cookie': self.cookie}],
+                                rate_limit=0,
+                                quarantine_time=0)
+        return IdentityPool(pool_config['identities'],
+                            strategy=pool_config.get('strategy',
+                                                     'round_robin'),
+                            rate_limit=pool_config.get('rate_limit', 0.5),
+                            quarantine_time=pool_config.get(
+                                'quarantine_time', 600))
+
     def is_date(self, since_date):
         """判断日期格式是否正确"""
         try:
@@ -98,11 +963,187 @@ class Weibo(object):
         except ValueError:
             return False
 
+    def request(self, url, params=None, timeout=(5, 10)):
+        """使用身份池中的身份发出请求，遇到封禁时自动换用其他身份重试"""
+        pool = self.identity_pool
+        response = None
+        error = None
+        for _ in range(len(pool.identities)):
+            identity = pool.acquire()
+            try:
+                response = requests.get(url,
+                                        params=params,
+                                        headers=pool.get_headers(identity),
+                                        proxies=pool.get_proxies(identity),
+                                        timeout=timeout)
+            except requests.exceptions.RequestException as e:
+                pool.report_failure(identity)
+                error = e
+                continue
+            if pool.is_banned(response):
+                pool.report_ban(identity)
+                continue
+            pool.report_success(identity)
+            return response
+        if response is None:
+            raise error
+        return response
+
+    def decode_json(self, response):
+        """解析响应中的json数据，封禁页面或非json内容抛出ResponseError"""
+        if self.identity_pool.is_banned(response):
+            raise ResponseError(u'请求被封禁(%d): %s' %
+                                (response.status_code, response.url),
+                                response)
+        try:
+            return loads_json(response.content)
+        except ValueError:
+            raise ResponseError(
+                u'响应不是json数据(%d): %s' % (response.status_code, response.url),
+                response)
+
+    def run_unit(self, kind, payload, func, *args):
+        """执行一个最小单元(一页搜索结果、一条微博、一次长微博获取或一页评论)
+
+        网络错误和无法解析的响应按指数退避重试，仍失败或出现其他错误时将该单元
+        写入死信文件并返回None，不影响同一页的其他单元
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                return func(*args)
+            except (requests.exceptions.RequestException,
+                    ResponseError) as e:
+                error = e
+                if attempt < self.max_retries:
+                    print(u'%s单元第%d次失败，%d秒后重试: %s' %
+                          (kind, attempt + 1, self.retry_backoff * 2**attempt,
+                           e))
+                    sleep(self.retry_backoff * 2**attempt)
+            except Exception as e:
+                error = e
+                break
+        print('Error: ', error)
+        traceback.print_exception(type(error), error, error.__traceback__)
+        self.add_dead_letter(kind, payload, error)
+
+    def get_dead_letter_path(self):
+        """获取死信文件路径"""
+        return os.path.dirname(
+            self.get_filepath('csv')) + os.sep + 'dead_letter.jsonl'
+
+    def add_dead_letter(self, kind, payload, error):
+        """将最终失败的单元追加写入死信文件"""
+        entry = {
+            'kind': kind,
+            'question': self.question,
+            'payload': payload,
+            'error': repr(error),
+            'failed_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            # 获取数据时的当前时间，重试时用于解析"刚刚"、"昨天"等相对时间
+            'clock': self.timestamps.now.strftime(TimestampNormalizer.FORMAT)
+        }
+        with open(self.get_dead_letter_path(), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.dead_letter_count += 1
+
+    def replay_unit(self, entry):
+        """重新执行一个死信单元"""
+        kind = entry['kind']
+        payload = entry['payload']
+        if kind == 'page':
+            self.get_one_page(payload['page'])
+        elif kind == 'comments':
+            self.get_review(payload['weibo_id'], payload['max_id'],
+                            payload['page'])
+        else:
+            # 单条微博及其长微博均重新解析整条微博。微博中的时间是相对于原先获取
+            # 时的时间("刚刚"、"昨天 HH:MM"等)，需使用当时的时间解析
+            clock = entry.get('clock') or entry['failed_at']
+            self.timestamps.set_clock(
+                datetime.strptime(clock, TimestampNormalizer.FORMAT))
+            card = payload['card'] if kind == 'long' else payload
+            dead_letter_count = self.dead_letter_count
+            result = self.run_unit('card', card,
+                                   self.get_one_weibo_with_status, card)
+            if result:
+                wb, is_complete = result
+                if kind != 'long' or is_complete:
+                    self.add_one_weibo(wb)
+                elif self.dead_letter_count == dead_letter_count:
+                    # 源微博在本次重试中已获取失败过，未再写入死信，需重新加入
+                    self.add_dead_letter(kind, payload,
+                                         ResponseError(u'长微博全文仍未获取'))
+            self.timestamps.reset_clock()
+
+    def load_replay_entries(self, dead_letter_path, replay_path):
+        """将死信文件合并到待重试文件中并读取，上次中断的重试不会丢失"""
+        if os.path.isfile(dead_letter_path):
+            with open(dead_letter_path, encoding='utf-8') as f:
+                content = f.read()
+            with open(replay_path, 'a', encoding='utf-8') as f:
+                f.write(content)
+            os.remove(dead_letter_path)
+        entries = []
+        seen = set()
+        with open(replay_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # 忽略中断时写了一半的行
+                key = (entry['kind'],
+                       json.dumps(entry['payload'], sort_keys=True))
+                if key not in seen:
+                    seen.add(key)
+                    entries.append(entry)
+        return entries
+
+    def replay_question(self, question):
+        """重新执行一个话题的死信单元"""
+        self.initialize_info(question)
+        self.analytics = None  # 只重试部分数据，不覆盖话题统计
+        dead_letter_path = self.get_dead_letter_path()
+        replay_path = dead_letter_path + '.replay'
+        if not os.path.isfile(dead_letter_path) and not os.path.isfile(
+                replay_path):
+            return
+        entries = self.load_replay_entries(dead_letter_path, replay_path)
+        print(u'话题%s共%d个失败单元，开始重试' % (question, len(entries)))
+        self.timestamps.reset_clock()
+        self.truncated_retweets.clear()  # 重试时需要重新获取源微博全文
+        for entry in tqdm(entries, desc='Replay'):
+            self.replay_unit(entry)
+        self.write_data(0)
+        self.close_partitions()
+        os.remove(replay_path)  # 数据全部写入后才删除，中断时下次重试会再次读取
+        remaining = 0
+        if os.path.isfile(dead_letter_path):
+            with open(dead_letter_path, encoding='utf-8') as f:
+                remaining = sum(1 for line in f if line.strip())
+        print(u'重试完毕，%d个单元仍失败' % remaining)
+
+    def replay(self):
+        """重新执行各话题死信文件中的单元，仍失败的单元写入新的死信文件"""
+        try:
+            for question in self.question_list:
+                try:
+                    self.replay_question(question)
+                except Exception as e:
+                    print(u'话题%s重试失败，未完成的单元保留到下次重试' % question)
+                    print('Error: ', e)
+                    traceback.print_exc()
+                finally:
+                    self.close_partitions()
+        finally:
+            if self.sqlite_connection:
+                self.sqlite_connection.close()
+                self.sqlite_connection = None
+
     def get_json(self, params):
         """获取网页中json数据"""
         url = 'https://m.weibo.cn/api/container/getIndex?'
-        r = requests.get(url, params=params)
-        return r.json()
+        r = self.request(url, params=params)
+        return self.decode_json(r)
 
     def get_weibo_json(self, page):
         """获取网页中微博json数据"""
@@ -110,6 +1151,16 @@ class Weibo(object):
         js = self.get_json(params)
         return js
 
+    def get_page_cards(self, page):
+        """获取一页中的全部卡片，数据格式错误时抛出ResponseError"""
+        js = self.get_weibo_json(page)
+        if not js.get('ok'):
+            return []
+        cards = (js.get('data') or {}).get('cards')
+        if not isinstance(cards, list):
+            raise ResponseError(u'第%d页的微博数据格式错误' % page)
+        return cards
+
     def user_to_mongodb(self):
         """将爬取的用户信息写入MongoDB数据库"""
         user_list = [self.user]
@@ -191,18 +1242,30 @@ class Weibo(object):
     def get_long_weibo(self, id):
         """获取长微博"""
         url = 'https://m.weibo.cn/detail/%s' % id
-        html = requests.get(url).text
-        html = html[html.find('"status":'):]
-        html = html[:html.rfind('"hotScheme"')]
-        html = html[:html.rfind(',')]
-        html = '{' + html + '}'
-        js = json.loads(html, strict=False)
+        response = self.request(url)
+        content = response.content
+        # 页面中嵌入的json为"status": {...}, ..., "hotScheme"，直接解析原始字节
+        start = content.find(b'"status":')
+        end = content.rfind(b',', start, content.rfind(b'"hotScheme"'))
+        if start == -1 or end == -1:
+            raise ResponseError(u'长微博页面中没有微博数据: %s' % url, response)
+        try:
+            js = loads_json(b'{' + content[start:end] + b'}')
+        except ValueError:
+            raise ResponseError(u'长微博数据不是json格式: %s' % url, response)
         weibo_info = js.get('status')
         if weibo_info:
             weibo = self.parse_weibo(weibo_info)
             return weibo
 
     
+    def get_long_weibo_unit(self, id, info):
+        """获取长微博，失败时记录所属微博，返回None时使用微博的非全文内容"""
+        return self.run_unit('long', {
+            'id': id,
+            'card': info
+        }, self.get_long_weibo, id)
+
     def get_pics(self, weibo_info):
         """获取微博原始图片url"""
         if weibo_info.get('pics'):
@@ -228,21 +1291,39 @@ class Weibo(object):
                             video_url = ''
         return video_url
 
+    def get_media_store(self):
+        """获取所有话题共用的图片/视频仓库"""
+        if not self.media_store:
+            store_dir = os.path.split(
+                os.path.realpath(__file__)
+            )[0] + os.sep + 'weibo' + os.sep + 'media_store'
+            self.media_store = MediaStore(store_dir)
+        return self.media_store
+
     def download_one_file(self, url, file_path, type, weibo_id):
-        """下载单个文件(图片/视频)"""
+        """下载单个文件(图片/视频)，已下载过的url直接从仓库链接"""
         try:
             if not os.path.isfile(file_path):
-                s = requests.Session()
-                s.mount(url, HTTPAdapter(max_retries=5))
-                downloaded = s.get(url, timeout=(5, 10))
-                with open(file_path, 'wb') as f:
-                    f.write(downloaded.content)
+                media_store = self.get_media_store()
+                object_path = media_store.get(url)
+                if not object_path:
+                    # 图片/视频来自CDN，不使用身份池，避免发送cookie或因文件已删除被误判为封禁
+                    s = requests.Session()
+                    s.mount(url, HTTPAdapter(max_retries=5))
+                    downloaded = s.get(url,
+                                       headers={'User-Agent': DEFAULT_USER_AGENT},
+                                       timeout=(5, 10))
+                    downloaded.raise_for_status()
+                    object_path = media_store.put(
+                        url, downloaded.content,
+                        os.path.splitext(file_path)[1])
+                media_store.link(object_path, file_path)
         except Exception as e:
             error_file = self.get_filepath(
                 type) + os.sep + 'not_downloaded.txt'
             with open(error_file, 'ab') as f:
                 url = str(weibo_id) + ':' + url + '\n'
-                f.write(url.encode(sys.stdout.encoding))
+                f.write(url.encode(self.sanitizer.encoding))
             print('Error: ', e)
             traceback.print_exc()
 
@@ -259,7 +1340,7 @@ class Weibo(object):
             file_dir = self.get_filepath(type)
             for w in tqdm(self.weibo, desc='Download progress'):
                 if w[key]:
-                    file_prefix = w['created_at'][:11].replace(
+                    file_prefix = w['created_at'][:10].replace(
                         '-', '') + '_' + str(w['id'])
                     if type == 'img' and ',' in w[key]:
                         w[key] = w[key].split(',')
@@ -332,108 +1413,104 @@ class Weibo(object):
             string = int(string[:-1] + '0000')
         return int(string)
 
+    def has_comments(self, mblog):
+        """判断微博是否有评论，评论数无法解析时也尝试获取评论"""
+        if 'id' not in mblog:
+            return False
+        try:
+            return self.string_to_int(mblog.get('comments_count', 0)) > 0
+        except (AttributeError, ValueError):
+            return True
+
     def standardize_date(self, created_at):
         """标准化微博发布时间"""
-        if u"刚刚" in created_at:
-            created_at = datetime.now().strftime("%Y-%m-%d")
-        elif u"分钟" in created_at:
-            minute = created_at[:created_at.find(u"分钟")]
-            minute = timedelta(minutes=int(minute))
-            created_at = (datetime.now() - minute).strftime("%Y-%m-%d")
-        elif u"小时" in created_at:
-            hour = created_at[:created_at.find(u"小时")]
-            hour = timedelta(hours=int(hour))
-            created_at = (datetime.now() - hour).strftime("%Y-%m-%d")
-        elif u"昨天" in created_at:
-            day = timedelta(days=1)
-            created_at = (datetime.now() - day).strftime("%Y-%m-%d")
-        elif created_at.count('-') == 1:
-            year = datetime.now().strftime("%Y")
-            created_at = year + "-" + created_at
-        return created_at
+        return self.timestamps.normalize(created_at)
 
     def standardize_info(self, weibo):
         """标准化信息，去除乱码"""
-        for k, v in weibo.items():
-            if 'int' not in str(type(v)) and 'long' not in str(
-                    type(v)) and 'bool' not in str(type(v)):
-                weibo[k] = v.replace(u"\u200b", "").encode(
-                    sys.stdout.encoding, "ignore").decode(sys.stdout.encoding)
-        return weibo
-    def get_review(self,id):
-        max_id = ""
-        try:
-            i=0 # 评论的页数
-            while True:
-                if max_id=="":
-                    url = 'https://m.weibo.cn/comments/hotflow?id=%s&mid=%s&max_id_type=0'% (id, id)
-                else:
-                    url = 'https://m.weibo.cn/comments/hotflow?id=%s&mid=%s&max_id=%s&max_id_type=0'% (id, id, max_id)
-                headers = {'User-Agent':'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/70.0.3534.4 Safari/537.36',
-                    'cookie' :self.cookie 
-                        }
-                
-                comment_num=1 # 爬取的评论总数量
-                req=requests.get(url,headers=headers)
-                comment_page=req.json()['data']['data']
-                if req.status_code==200:
-                    print('读取%s页的评论：'%str(i+1))
-                    for j in range(0,len(comment_page)):
-                        # print('第%s条评论'%comment_num)
-                        weibo_info = defaultdict(defaultdict)
-                        user = comment_page[j]
-                        weibo_info['user_id'] = user['user']['id']      #用户id
-                        weibo_info['screen_name'] = user['user']['screen_name']    #发表评论的用户名
-                        weibo_info['id'] = user['id']     #微博文本的编号
-                        weibo_info['bid'] = ''
-                        # text=re.sub('<.*?>|回复<.*?>:|[\U00010000-\U0010ffff]|[\uD800-\uDBFF][\uDC00-\uDFFF]','',user['text'])
-                        text = user['text']
-                        text = re.sub('<.*?alt=|回复<.*?alt=|src.*?png', '', text)
-                        # fliter_text =re.sub('[\U00010000-\U0010ffff]|[\uD800-\uDBFF][\uDC00-\uDFFF]','',text) # 去除评论中表情等的特殊字符
-                        """必须包含表情,且不能只有一个表情"""
-                        # if fliter_text != text and fliter_text != "": 
-                        text = re.sub('style.*?span>','',text)
-                        """做一个匹配"""
-                        text = re.sub('\n','',text)
-                        weibo_info['text'] = text
-                        
-                        # print(text)
-                        weibo_info['location'] = ''
-                        weibo_info['created_at'] = user['created_at']#发表时间
-                        weibo_info['source'] = ''
-                        weibo_info['attitudes_count']=user['like_count']#点赞数
-                        # print('点赞数'+str(weibo_info['attitudes_count']))
-                        weibo_info['comments_count'] = 0
-                        weibo_info['reposts_count'] = 0
-                        weibo_info['topics'] = ''
-                        weibo_info['at_users'] = ''
-                        
-    
-                    
-                        comment_num+=1
-                        wb = weibo_info
-                        """这个地方可能需要进行修改，修改为可以对评论文本进行进一步处理的内容"""
-                        if wb:
-                            self.weibo.append(wb)
-                            self.weibo_id_list.append(wb['id'])
-                            self.got_count = self.got_count + 1
-                            self.print_weibo(wb)
-                        # else:
-                        #     continue
-                    i+=1
-                    result = req.json()
-                    max_id = result.get("data").get("max_id")
-                    if max_id==0:
-                        break
-                    sleep(random.randint(2,4))  #防止反爬虫机制，停止一会~~~~
-                else:
-                    break
-            return ''
-        except Exception as e:
-            print("Error: ", e)
-            traceback.print_exc()
-            
-            # https://m.weibo.cn/api/comments/show?id=4525451148756558&page=2
+        return self.sanitizer.sanitize_record(weibo)
+    def get_review(self, id, max_id="", i=0):
+        """获取一条微博的评论，从max_id对应的第i+1页开始"""
+        while True:
+            max_id = self.run_unit('comments', {
+                'weibo_id': id,
+                'max_id': max_id,
+                'page': i
+            }, self.get_review_page, id, max_id, i)
+            if not max_id:  # 评论已全部获取或该页最终失败
+                break
+            i+=1
+            if not self.identity_pool.is_paced():  # 已配置限速时由身份池控制节奏
+                sleep(random.randint(2,4))  #防止反爬虫机制，停止一会~~~~
+        return ''
+        # https://m.weibo.cn/api/comments/show?id=4525451148756558&page=2
+
+    def get_review_page(self, id, max_id, i):
+        """获取一页评论，返回下一页的max_id，没有下一页时返回0"""
+        if max_id=="":
+            url = 'https://m.weibo.cn/comments/hotflow?id=%s&mid=%s&max_id_type=0'% (id, id)
+        else:
+            url = 'https://m.weibo.cn/comments/hotflow?id=%s&mid=%s&max_id=%s&max_id_type=0'% (id, id, max_id)
+        comment_num=1 # 爬取的评论总数量
+        comment_list = []
+        req=self.request(url)
+        if req.status_code!=200:
+            raise ResponseError(u'评论页请求失败(%d): %s' % (req.status_code, url), req)
+        result = self.decode_json(req)
+        if not result.get('ok'):  # 没有更多评论
+            return 0
+        comment_page = result['data']['data']
+        print('读取%s页的评论：'%str(i+1))
+        for j in range(0,len(comment_page)):
+            # print('第%s条评论'%comment_num)
+            weibo_info = defaultdict(defaultdict)
+            user = comment_page[j]
+            weibo_info['user_id'] = user['user']['id']      #用户id
+            weibo_info['screen_name'] = user['user']['screen_name']    #发表评论的用户名
+            weibo_info['id'] = user['id']     #微博文本的编号
+            weibo_info['bid'] = ''
+            # text=re.sub('<.*?>|回复<.*?>:|[\U00010000-\U0010ffff]|[\uD800-\uDBFF][\uDC00-\uDFFF]','',user['text'])
+            text = user['text']
+            text = re.sub('<.*?alt=|回复<.*?alt=|src.*?png', '', text)
+            # fliter_text =re.sub('[\U00010000-\U0010ffff]|[\uD800-\uDBFF][\uDC00-\uDFFF]','',text) # 去除评论中表情等的特殊字符
+            """必须包含表情,且不能只有一个表情"""
+            # if fliter_text != text and fliter_text != "": 
+            text = re.sub('style.*?span>','',text)
+            """做一个匹配"""
+            text = re.sub('\n','',text)
+            weibo_info['text'] = text
+
+            # print(text)
+            weibo_info['location'] = ''
+            weibo_info['created_at'] = self.standardize_date(user['created_at'])#发表时间
+            weibo_info['source'] = ''
+            weibo_info['attitudes_count']=user['like_count']#点赞数
+            # print('点赞数'+str(weibo_info['attitudes_count']))
+            weibo_info['comments_count'] = 0
+            weibo_info['reposts_count'] = 0
+            weibo_info['topics'] = ''
+            weibo_info['at_users'] = ''
+
+            comment_num+=1
+            wb = weibo_info
+            """这个地方可能需要进行修改，修改为可以对评论文本进行进一步处理的内容"""
+            if wb:
+                comment_list.append(wb)
+            # else:
+            #     continue
+        # 整页解析成功后再保存，重试时不会重复保存
+        for wb in self.sanitizer.sanitize_records(comment_list):
+            self.comment_parent[wb['id']] = id
+            if self.analytics:
+                self.analytics.add_comment(
+                    wb,
+                    self.timestamps.to_timestamp(
+                        wb['created_at']))
+            self.weibo.append(wb)
+            self.weibo_id_list.append(wb['id'])
+            self.got_count = self.got_count + 1
+            self.print_weibo(wb)
+        return result.get("data").get("max_id")
 
 
     def parse_weibo(self, weibo_info):
@@ -462,7 +1539,7 @@ class Weibo(object):
             weibo_info['reposts_count'])
         weibo['topics'] = self.get_topics(selector)
         weibo['at_users'] = self.get_at_users(selector)
-        return self.standardize_info(weibo)
+        return self.sanitizer.sanitize_record(weibo)
 
     def print_user_info(self):
         """打印用户信息"""
@@ -507,11 +1584,14 @@ class Weibo(object):
         
     def get_one_weibo(self, info):
         """获取一条微博的全部信息"""
+        return self.get_one_weibo_with_status(info)[0]
+
+    def get_one_weibo_with_status(self, info):
+        """获取一条微博的全部信息，并返回是否获取到了全文"""
         #try:
+        is_complete = True  # 微博及源微博是否都获取到了全文
         weibo_info = info['mblog']
         weibo_id = weibo_info['id']
-        if weibo_info['comments_count']>0: 
-            self.get_review(weibo_id)
         # print("\n\n*************开始提取正文了1\n\n")
         retweeted_status = weibo_info.get('retweeted_status')
         is_long = weibo_info['isLongText']
@@ -519,25 +1599,40 @@ class Weibo(object):
             retweet_id = retweeted_status['id']
             is_long_retweet = retweeted_status['isLongText']
             if is_long:
-                weibo = self.get_long_weibo(weibo_id)  #长微博处理函数
+                weibo = self.get_long_weibo_unit(weibo_id, info)  #长微博处理函数
                 if not weibo:
                     weibo = self.parse_weibo(weibo_info)  #微博存在内存中，暂时还没有写入文件或数据库
+                    is_complete = False
             else:
                 weibo = self.parse_weibo(weibo_info)
-            if is_long_retweet:                                          #retweet代表是否为转发微博
-                retweet = self.get_long_weibo(retweet_id)
-                if not retweet:
+            retweet = self.retweet_cache.get(retweet_id)  #同一源微博只解析一次
+            if retweet is None:
+                retweet = self.truncated_retweets.get(retweet_id)
+                if retweet is not None:  # 全文已获取失败过，直接使用截断的正文
+                    is_complete = False
+            if retweet is None:
+                is_retweet_complete = True  # 是否获取到了源微博全文
+                if is_long_retweet:                                          #retweet代表是否为转发微博
+                    retweet = self.get_long_weibo_unit(retweet_id, info)
+                    if not retweet:
+                        retweet = self.parse_weibo(retweeted_status)
+                        is_retweet_complete = False
+                else:
                     retweet = self.parse_weibo(retweeted_status)
-            else:
-                retweet = self.parse_weibo(retweeted_status)
-            retweet['created_at'] = self.standardize_date(
-                retweeted_status['created_at'])
-            weibo['retweet'] = retweet
+                retweet['created_at'] = self.standardize_date(
+                    retweeted_status['created_at'])
+                if is_retweet_complete:
+                    self.retweet_cache.put(retweet_id, retweet)
+                else:  # 失败的获取已写入死信，之后的转发不再重复获取
+                    self.truncated_retweets.put(retweet_id, retweet)
+                    is_complete = False
+            weibo['retweet'] = OrderedDict(retweet)  #写入数据库时会修改源微博，需使用副本
         else:  # 原创
             if is_long:
-                weibo = self.get_long_weibo(weibo_id)
+                weibo = self.get_long_weibo_unit(weibo_id, info)
                 if not weibo:
                     weibo = self.parse_weibo(weibo_info)
+                    is_complete = False
             else:
                 weibo = self.parse_weibo(weibo_info)
         weibo['created_at'] = self.standardize_date(
@@ -546,7 +1641,7 @@ class Weibo(object):
         # """必须包含表情,且不能只有一个表情"""
         # if fliter_text != weibo["text"] and fliter_text != "": 
         #     weibo = None
-        return weibo
+        return weibo, is_complete
         #except Exception as e:
             #print("Error: ", e)
             #traceback.print_exc()
@@ -566,12 +1661,20 @@ class Weibo(object):
     def get_one_page(self, page):
         """获取一页的全部微博"""
         try:
-            js = self.get_weibo_json(page)
-            if js['ok']:
-                weibos = js['data']['cards']
+            self.timestamps.reset_clock()  # 同一页的微博和评论共用一次当前时间
+            weibos = self.run_unit('page', {'page': page},
+                                   self.get_page_cards, page)
+            if weibos:
                 for w in weibos:
-                    if w['card_type'] == 9:
-                        wb = self.get_one_weibo(w)
+                    if w.get('card_type') == 9:
+                        wb = self.run_unit('card', w, self.get_one_weibo, w)
+                        mblog = w.get('mblog') or {}
+                        if self.has_comments(mblog):
+                            try:
+                                self.get_review(mblog['id'])
+                            except Exception as e:  # 评论获取失败不影响本页其余微博
+                                print("Error: ", e)
+                                traceback.print_exc()
                         if wb==None:
                             continue
                         """接收判断是否为含表情的文本"""
@@ -591,18 +1694,27 @@ class Weibo(object):
                         #             continue
                         #         else:
                         #             return True
-                        if (not self.filter) or (
-                                'retweet' not in wb.keys()):
-                            # print("\n\n*************开始提取正文了3\n\n")
-                            self.weibo.append(wb)                                        #self.weibo = []  # 存储爬取到的所有微博信息
-                            self.weibo_id_list.append(wb['id'])
-                            self.got_count = self.got_count + 1
-                            # print(self.got_count)
-                            # self.print_weibo(wb)
+                        self.add_one_weibo(wb)
         except Exception as e:
             print("Error: ", e)
             traceback.print_exc()
 
+    def add_one_weibo(self, wb):
+        """保存一条微博，filter为1时忽略转发微博"""
+        if (not self.filter) or (
+                'retweet' not in wb.keys()):
+            # print("\n\n*************开始提取正文了3\n\n")
+            if self.analytics:
+                self.analytics.add_post(
+                    wb,
+                    self.timestamps.to_timestamp(
+                        wb['created_at']))
+            self.weibo.append(wb)                                        #self.weibo = []  # 存储爬取到的所有微博信息
+            self.weibo_id_list.append(wb['id'])
+            self.got_count = self.got_count + 1
+            # print(self.got_count)
+            # self.print_weibo(wb)
+
     def get_page_count(self):
         """获取微博页数"""
         weibo_count = self.user['statuses_count']
@@ -613,24 +1725,28 @@ class Weibo(object):
         """获取要写入的微博信息"""
         write_info = []
         for w in self.weibo[wrote_count:]:
-            wb = OrderedDict()
-            for k, v in w.items():
-                if k not in ['user_id', 'screen_name', 'retweet']:
-                    if 'unicode' in str(type(v)):
-                        v = v.encode('utf-8')
-                    wb[k] = v
-            if not self.filter:
-                if w.get('retweet'):
-                    wb['is_original'] = False
-                    for k2, v2 in w['retweet'].items():
-                        if 'unicode' in str(type(v2)):
-                            v2 = v2.encode('utf-8')
-                        wb['retweet_' + k2] = v2
-                else:
-                    wb['is_original'] = True
-            write_info.append(wb)
+            write_info.append(self.get_one_write_info(w))
         return write_info
 
+    def get_one_write_info(self, w):
+        """获取一条要写入的微博信息"""
+        wb = OrderedDict()
+        for k, v in w.items():
+            if k not in ['user_id', 'screen_name', 'retweet']:
+                if 'unicode' in str(type(v)):
+                    v = v.encode('utf-8')
+                wb[k] = v
+        if not self.filter:
+            if w.get('retweet'):
+                wb['is_original'] = False
+                for k2, v2 in w['retweet'].items():
+                    if 'unicode' in str(type(v2)):
+                        v2 = v2.encode('utf-8')
+                    wb['retweet_' + k2] = v2
+            else:
+                wb['is_original'] = True
+        return wb
+
     def get_filepath(self, type):
         """获取结果文件路径"""
         try:
@@ -666,20 +1782,24 @@ class Weibo(object):
         write_info = self.get_write_info(wrote_count)
         result_headers = self.get_result_headers()
         result_data = [w.values() for w in write_info]
+        file_path = self.get_filepath('csv')
+        # 重复运行时文件已有表头，不再重复写入
+        write_header = wrote_count == 0 and (not os.path.isfile(file_path)
+                                             or os.path.getsize(file_path) == 0)
         if sys.version < '3':  # python2.x
-            with open(self.get_filepath('csv'), 'ab') as f:
+            with open(file_path, 'ab') as f:
                 f.write(codecs.BOM_UTF8)
                 writer = csv.writer(f)
-                if wrote_count == 0:
+                if write_header:
                     writer.writerows([result_headers])
                 writer.writerows(result_data)
         else:  # python3.x
-            with open(self.get_filepath('csv'),
+            with open(file_path,
                       'a',
                       encoding='utf-8-sig',
                       newline='') as f:
                 writer = csv.writer(f)
-                if wrote_count == 0:
+                if write_header:
                     writer.writerows([result_headers])
                 writer.writerows(result_data)
         print(u'%d条微博写入csv文件完毕,保存路径:' % self.got_count)
@@ -821,11 +1941,233 @@ class Weibo(object):
         self.mysql_insert(mysql_config, 'weibo', weibo_list)
         print(u'%d条微博写入MySQL数据库完毕' % self.got_count)
 
+    def get_sqlite_connection(self):
+        """获取SQLite数据库连接，首次连接时创建表和全文索引"""
+        if self.sqlite_connection:
+            return self.sqlite_connection
+        db_dir = os.path.split(
+            os.path.realpath(__file__))[0] + os.sep + 'weibo'
+        if not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+        connection = sqlite3.connect(db_dir + os.sep + 'weibo.db')
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        post_columns = """
+                id INTEGER PRIMARY KEY,
+                bid TEXT,
+                user_id TEXT,
+                screen_name TEXT,
+                text TEXT,
+                pics TEXT,
+                video_url TEXT,
+                location TEXT,
+                created_at TEXT,
+                source TEXT,
+                attitudes_count INTEGER,
+                comments_count INTEGER,
+                reposts_count INTEGER,
+                topics TEXT,
+                at_users TEXT,"""
+        with connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS questions (
+                question TEXT PRIMARY KEY,
+                statuses_count INTEGER,
+                crawled_count INTEGER,
+                updated_at TEXT)""")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS posts (%s
+                retweet_id INTEGER,
+                question TEXT)""" % post_columns)
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS retweets (%s
+                question TEXT)""" % post_columns)
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS comments (
+                id INTEGER PRIMARY KEY,
+                weibo_id INTEGER,
+                user_id TEXT,
+                screen_name TEXT,
+                text TEXT,
+                created_at TEXT,
+                attitudes_count INTEGER,
+                topics TEXT,
+                at_users TEXT,
+                question TEXT)""")
+            for table in ['posts', 'retweets', 'comments']:
+                connection.execute(
+                    'CREATE INDEX IF NOT EXISTS {table}_created_at ON '
+                    '{table} (created_at)'.format(table=table))
+                self.sqlite_create_fts(connection, table)
+        self.sqlite_connection = connection
+        return connection
+
+    def sqlite_create_fts(self, connection, table):
+        """为表的text、topics、at_users字段创建FTS5全文索引，并用触发器保持同步"""
+        # trigram分词支持中文子串检索，旧版SQLite只能使用默认分词
+        tokenize = 'trigram' if sqlite3.sqlite_version_info >= (3, 34,
+                                                                0) else 'unicode61'
+        columns = 'text, topics, at_users'
+        new_values = 'new.text, new.topics, new.at_users'
+        old_values = 'old.text, old.topics, old.at_users'
+        try:
+            connection.execute(
+                """CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5(
+                {columns}, content='{table}', content_rowid='id',
+                tokenize='{tokenize}')""".format(table=table,
+                                                 columns=columns,
+                                                 tokenize=tokenize))
+        except sqlite3.OperationalError as e:
+            print(u'SQLite不支持FTS5，%s表不建立全文索引: %s' % (table, e))
+            return
+        connection.executescript("""
+            CREATE TRIGGER IF NOT EXISTS {table}_ai AFTER INSERT ON {table} BEGIN
+                INSERT INTO {table}_fts(rowid, {columns})
+                VALUES (new.id, {new});
+            END;
+            CREATE TRIGGER IF NOT EXISTS {table}_ad AFTER DELETE ON {table} BEGIN
+                INSERT INTO {table}_fts({table}_fts, rowid, {columns})
+                VALUES ('delete', old.id, {old});
+            END;
+            CREATE TRIGGER IF NOT EXISTS {table}_au AFTER UPDATE ON {table} BEGIN
+                INSERT INTO {table}_fts({table}_fts, rowid, {columns})
+                VALUES ('delete', old.id, {old});
+                INSERT INTO {table}_fts(rowid, {columns})
+                VALUES (new.id, {new});
+            END;""".format(table=table,
+                           columns=columns,
+                           new=new_values,
+                           old=old_values))
+
+    def sqlite_upsert(self, connection, table, data_list):
+        """向SQLite表插入或按id更新数据"""
+        if len(data_list) > 0:
+            keys = list(data_list[0].keys())
+            sql = """INSERT INTO {table}({keys}) VALUES ({values}) ON
+                     CONFLICT(id) DO UPDATE SET {update}""".format(
+                table=table,
+                keys=', '.join(keys),
+                values=', '.join(['?'] * len(keys)),
+                update=', '.join(
+                    ['{key} = excluded.{key}'.format(key=key)
+                     for key in keys if key != 'id']))
+            connection.executemany(
+                sql, [tuple(data[key] for key in keys) for data in data_list])
+
+    def get_sqlite_post(self, w):
+        """获取要写入SQLite的微博字段"""
+        post = OrderedDict()
+        for key in [
+                'id', 'bid', 'user_id', 'screen_name', 'text', 'pics',
+                'video_url', 'location', 'created_at', 'source',
+                'attitudes_count', 'comments_count', 'reposts_count',
+                'topics', 'at_users'
+        ]:
+            post[key] = w.get(key, '')
+        if isinstance(post['pics'], list):
+            post['pics'] = ','.join(post['pics'])
+        post['question'] = self.question
+        return post
+
+    def weibo_to_sqlite(self, wrote_count):
+        """将爬取的微博及评论信息写入SQLite数据库，每次写入为一个事务"""
+        post_list = []
+        retweet_list = []
+        comment_list = []
+        for w in self.weibo[wrote_count:]:
+            if w['id'] in self.comment_parent:
+                comment = OrderedDict()
+                comment['id'] = w['id']
+                comment['weibo_id'] = self.comment_parent[w['id']]
+                for key in [
+                        'user_id', 'screen_name', 'text', 'created_at',
+                        'attitudes_count', 'topics', 'at_users'
+                ]:
+                    comment[key] = w[key]
+                comment['question'] = self.question
+                comment_list.append(comment)
+                continue
+            post = self.get_sqlite_post(w)
+            post['retweet_id'] = None
+            if w.get('retweet'):
+                retweet_list.append(self.get_sqlite_post(w['retweet']))
+                post['retweet_id'] = w['retweet']['id']
+            elif w.get('retweet_id'):
+                post['retweet_id'] = w['retweet_id']
+            post_list.append(post)
+        connection = self.get_sqlite_connection()
+        with connection:
+            self.sqlite_upsert(connection, 'retweets', retweet_list)
+            self.sqlite_upsert(connection, 'posts', post_list)
+            self.sqlite_upsert(connection, 'comments', comment_list)
+            connection.execute(
+                """INSERT INTO questions(question, statuses_count,
+                crawled_count, updated_at) VALUES (?, ?,
+                (SELECT COUNT(*) FROM posts WHERE question = ?), ?) ON
+                CONFLICT(question) DO UPDATE SET
+                statuses_count = COALESCE(excluded.statuses_count,
+                                          statuses_count),
+                crawled_count = excluded.crawled_count,
+                updated_at = excluded.updated_at""",
+                (self.question, self.user.get('statuses_count'),
+                 self.question,
+                 datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        print(u'%d条微博写入SQLite数据库完毕' % self.got_count)
+
+    def get_comment_headers(self):
+        """获取要写入评论分区文件的表头"""
+        return ['id', '微博id', '用户id', '用户昵称', '正文', '日期', '点赞数']
+
+    def weibo_to_partitions(self, wrote_count):
+        """将爬到的微博和评论按发布日期写入分区文件"""
+        if not self.partition_writer:
+            partition_dir = os.path.dirname(
+                self.get_filepath('csv')) + os.sep + 'partitions'
+            self.partition_writer = PartitionWriter(
+                partition_dir,
+                compression=self.partition_config.get('compression', 'gzip'),
+                max_bytes=self.partition_config.get('max_bytes',
+                                                    256 * 1024 * 1024))
+        headers = {
+            'posts': self.get_result_headers(),
+            'comments': self.get_comment_headers()
+        }
+        # 先按(类型, 日期)分组，每个分区一次写入，避免评论日期乱序时频繁切换文件
+        groups = OrderedDict()
+        for w in self.weibo[wrote_count:]:
+            if w['id'] in self.comment_parent:
+                kind = 'comments'
+                row = [
+                    w['id'], self.comment_parent[w['id']], w['user_id'],
+                    w['screen_name'], w['text'], w['created_at'],
+                    w['attitudes_count']
+                ]
+            else:
+                kind = 'posts'
+                row = list(self.get_one_write_info(w).values())
+            key = (kind, self.partition_writer.get_day(w['created_at']))
+            groups.setdefault(key, []).append((w['id'], row))
+        for (kind, day), rows in groups.items():
+            self.partition_writer.write_rows(kind, day, headers[kind], rows)
+        self.partition_writer.flush()
+        print(u'%d条微博写入分区文件完毕,保存路径:' % self.got_count)
+        print(self.partition_writer.base_dir)
+
+    def close_partitions(self):
+        """关闭当前话题的分区文件"""
+        if self.partition_writer:
+            self.partition_writer.close_all()
+            self.partition_writer = None
+
     def write_data(self, wrote_count):
         """将爬到的信息写入文件或数据库"""
         if self.got_count > wrote_count:
             if 'csv' in self.write_mode:
                 self.write_csv(wrote_count)
+            if 'sqlite' in self.write_mode:
+                self.weibo_to_sqlite(wrote_count)
+            if 'partition' in self.write_mode:
+                self.weibo_to_partitions(wrote_count)
             if 'mysql' in self.write_mode:
                 self.weibo_to_mysql(wrote_count)
             if 'mongo' in self.write_mode:
@@ -849,16 +2191,36 @@ class Weibo(object):
             if page % 1 == 0:  # 每页写入一次文件
                 self.write_data(wrote_count)
                 wrote_count = self.got_count
+                self.write_summary()
 
             # 通过加入随机等待避免被限制。爬虫速度过快容易被系统限制(一段时间后限
             # 制会自动解除)，加入随机等待模拟人的操作，可降低被系统限制的风险。默
-            # 认是每爬取1到5页随机等待6到10秒，如果仍然被限，可适当增加sleep时间
-            if page - page1 == random_pages and page < page_count:
+            # 认是每爬取1到5页随机等待6到10秒，如果仍然被限，可适当增加sleep时间。
+            # 配置了身份池限速时由各身份分别限速，不再统一等待
+            if (page - page1 == random_pages and page < page_count
+                    and not self.identity_pool.is_paced()):
                 sleep(random.randint(6, 10))
                 page1 = page
                 random_pages = random.randint(1, 5)
         self.write_data(wrote_count)  # 将剩余不足20页的微博写入文件
+        self.close_partitions()
+        self.write_summary()
         print(u'微博爬取完成，共爬取%d条微博' % self.got_count)
+        stats = self.retweet_cache.get_stats()
+        print(u'源微博缓存命中%d次，未命中%d次，命中率%.1f%%' %
+              (stats['hits'], stats['misses'], stats['hit_rate'] * 100))
+
+    def write_summary(self):
+        """将话题统计数据写入json文件"""
+        if not self.analytics:
+            return
+        file_path = os.path.dirname(self.get_filepath(
+            'csv')) + os.sep + self.question + '_summary.json'
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump(self.analytics.get_summary(),
+                      f,
+                      ensure_ascii=False,
+                      indent=2)
 
     def get_user_list(self, file_name):
         """获取文件中的微博id信息"""
@@ -878,6 +2240,9 @@ class Weibo(object):
         self.got_count = 0
         self.question = question
         self.weibo_id_list = []
+        self.comment_parent = {}
+        if self.analytics_enabled:
+            self.analytics = TopicAnalytics()
 
     def start(self):
         """运行爬虫"""
@@ -894,10 +2259,150 @@ class Weibo(object):
         except Exception as e:
             print('Error: ', e)
             traceback.print_exc()
+        finally:
+            self.close_partitions()
+            if self.sqlite_connection:
+                self.sqlite_connection.close()
+                self.sqlite_connection = None
+
+
+def get_id_key(weibo_id):
+    """获取用于排序的id，数字id按数值排序"""
+    if weibo_id.isdigit():
+        return (0, int(weibo_id))
+    return (1, weibo_id)
+
+
+def write_csv_run(rows, run_dir):
+    """将排好序的一批行写入临时文件，返回文件路径"""
+    rows.sort(key=lambda row: (get_id_key(row[1]), row[0]))
+    fd, run_path = tempfile.mkstemp(suffix='.csv', dir=run_dir)
+    with io.open(fd, 'w', encoding='utf-8', newline='') as f:
+        csv.writer(f).writerows(rows)
+    return run_path
+
+
+def read_csv_run(run_path):
+    """按顺序读取临时文件中的行，首列为行的先后序号"""
+    with open(run_path, encoding='utf-8', newline='') as f:
+        for row in csv.reader(f):
+            yield get_id_key(row[1]), int(row[0]), row[1:]
+
+
+def compact_csv(input_paths, output_path, chunk_rows=50000):
+    """按id合并去重多个csv文件，保留最后写入的行(即最新的点赞、评论、转发数)
+
+    采用外部排序，内存中最多保存chunk_rows行。输出文件按id排序，只有一行表头，
+    同时生成output_path.idx索引文件，记录每个id所在行的字节偏移
+    """
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    run_dir = tempfile.mkdtemp(dir=output_dir)
+    run_paths = []
+    header = None
+    rows = []
+    seq = 0
+    try:
+        for input_path in input_paths:
+            with open(input_path, encoding='utf-8-sig', newline='') as f:
+                for row in csv.reader(f):
+                    if not row:
+                        continue
+                    row[0] = row[0].lstrip(u'\ufeff')  # 追加写入时可能残留的BOM
+                    if row[0] == 'id':
+                        header = header or row
+                        continue
+                    rows.append([seq] + row)
+                    seq += 1
+                    if len(rows) >= chunk_rows:
+                        run_paths.append(write_csv_run(rows, run_dir))
+                        rows = []
+        if rows:
+            run_paths.append(write_csv_run(rows, run_dir))
+            rows = []
+        count = 0
+        with open(output_path, 'wb') as out, open(output_path + '.idx',
+                                                  'w',
+                                                  encoding='utf-8') as idx:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+
+            def write_row(row):
+                buffer.seek(0)
+                buffer.truncate()
+                writer.writerow(row)
+                return out.write(buffer.getvalue().encode('utf-8'))
+
+            out.write(codecs.BOM_UTF8)
+            if header:
+                write_row(header)
+            last_key = None
+            last_row = None
+            merged = heapq.merge(*[read_csv_run(p) for p in run_paths])
+            for key, _, row in merged:
+                if key != last_key and last_row is not None:
+                    idx.write('%s\t%d\n' % (last_row[0], out.tell()))
+                    write_row(last_row)
+                    count += 1
+                last_key = key
+                last_row = row  # 同一id按序号排序，最后一行为最新数据
+            if last_row is not None:
+                idx.write('%s\t%d\n' % (last_row[0], out.tell()))
+                write_row(last_row)
+                count += 1
+    finally:
+        for run_path in run_paths:
+            os.remove(run_path)
+        os.rmdir(run_dir)
+    print(u'共%d行，去重后%d行，保存路径:' % (seq, count))
+    print(output_path)
+    return count
+
+
+def read_index_line(f, position):
+    """读取索引文件中第一个起始位置不小于position的行"""
+    f.seek(max(position - 1, 0))
+    if position > 0:
+        f.readline()
+    return f.readline()
+
+
+def lookup_csv(csv_path, weibo_id):
+    """根据compact_csv生成的索引二分查找一条微博，不存在时返回None"""
+    weibo_id = str(weibo_id)
+    key = get_id_key(weibo_id)
+    index_path = csv_path + '.idx'
+    with open(index_path, 'rb') as f:
+        low, high = 0, os.path.getsize(index_path)
+        while low < high:
+            middle = (low + high) // 2
+            line = read_index_line(f, middle)
+            if line and get_id_key(
+                    line.split(b'\t')[0].decode('utf-8')) < key:
+                low = middle + 1
+            else:
+                high = middle
+        line = read_index_line(f, low).decode('utf-8')
+    if not line or line.split('\t')[0] != weibo_id:
+        return None
+    with open(csv_path, 'rb') as f:
+        f.seek(int(line.rstrip('\n').split('\t')[1]))
+        reader = csv.reader(io.TextIOWrapper(f, encoding='utf-8',
+                                             newline=''))
+        return next(reader)
 
 
 def main():
     try:
+        if len(sys.argv) > 1 and sys.argv[1] == 'compact':
+            if len(sys.argv) < 4:
+                sys.exit(u'用法：python weibo.py compact 输出文件 输入文件1 [输入文件2 ...]')
+            compact_csv(sys.argv[3:], sys.argv[2])
+            return
+        if len(sys.argv) > 1 and sys.argv[1] == 'lookup':
+            if len(sys.argv) != 4:
+                sys.exit(u'用法：python weibo.py lookup 合并后的文件 微博id')
+            print(lookup_csv(sys.argv[2], sys.argv[3]))
+            return
         config_path = os.path.split(
             os.path.realpath(__file__))[0] + os.sep + 'config.json'
         if not os.path.isfile(config_path):
@@ -906,7 +2411,10 @@ def main():
         with open(config_path) as f:
             config = json.loads(f.read())
         wb = Weibo(config)
-        wb.start()  # 爬取微博信息
+        if len(sys.argv) > 1 and sys.argv[1] == 'replay':
+            wb.replay()  # 重试死信文件中的失败单元
+        else:
+            wb.start()  # 爬取微博信息
     except ValueError:
         print(u'config.json 格式不正确，请参考 '
               u'https://github.com/dataabc/weibo-crawler#3程序设置')